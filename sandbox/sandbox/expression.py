@@ -31,12 +31,23 @@ Currently supported:
 
 # >> Standard lib
 import itertools
+import logging
+import mmap
 
 from collections import defaultdict
+from contextlib import contextmanager
 from pathlib import Path
 
 # >> Third-party libs
 import duckdb
+import numpy
+import pyarrow
+
+
+# ------------------------------
+# Module variables
+
+logger = logging.getLogger(__name__)
 
 
 # ------------------------------
@@ -47,51 +58,133 @@ def ParseIDs(mtx_metafile: Path):
     Parses the MTX-formatted file containing metadata of the expression matrix. The
     metadata is either for columns or rows, but in both cases we are interested in the
     first column (if there are many).
-    """
 
-    metadata = {}
+    The IDs are returned as a numpy array indexed by their (1-based) position in the
+    file, so that a whole column of matrix indices can be mapped to IDs at once. Index 0
+    is an empty placeholder.
+    """
 
+    # only split off the first field; strip it the same as `LoadClusters` trims cell IDs
     with mtx_metafile.open() as file_handle:
-        for ndx, line in enumerate(file_handle, start=1):
-            metadata[ndx] = line.strip().split('\t')[0]
+        metadata = [''] + [line.split('\t', 1)[0].strip() for line in file_handle]
+
+    return numpy.array(metadata, dtype=object)
 
-    return metadata
 
+def ParseMatrixHeader(mtx_datafile: Path):
+    """
+    Parses the header of an MTX-formatted file and returns a tuple of: the number of
+    lines that precede the matrix entries (the comment lines, prefixed by '%', and the
+    line with the matrix dimensions), the matrix dimensions (row count, column count,
+    entry count), and the delimiter between the values of an entry.
+
+    Entries may be separated by any whitespace, but only a single space or a single tab
+    can be read by duckdb's CSV reader. For anything else the delimiter is None, though
+    `StreamMatrixData` can still parse the entries.
+    """
 
-def StreamMatrixData(mtx_datafile: Path, batch_size: int = 1024):
-    # A convenience function to normalize each row of the matrix as we iterate
-    def normalize(matrix_row):
-        return int(matrix_row[0]), int(matrix_row[1]), float(matrix_row[2])
+    header_size, matrix_dims = 0, None
 
-    batch_stopndx , row_batch = 0, []
     with mtx_datafile.open() as file_handle:
-        for ndx, line in enumerate(file_handle):
-            stripped_line = line.strip()
+        # >> Skip comment lines until the dimensions line; entries are never checked
+        for line in file_handle:
+            header_size += 1
+
+            if not line.startswith('%'):
+                matrix_dims = tuple(int(dim) for dim in line.split())
+                break
+
+        # >> Check the first entry against splitting on any whitespace
+        entry_line = file_handle.readline().rstrip('\r\n')
 
-            if stripped_line.startswith('%'): continue
+    entry_values = entry_line.split(None, 2)
+    delimiter    = '\t' if '\t' in entry_line else ' '
 
-            # mark the last row of the batch
-            if not batch_stopndx:
-                batch_stopndx = ndx + (batch_size - 1)
+    if entry_values and entry_line.split(delimiter) != entry_values:
+        delimiter = None
 
-            # if batch is complete, yield and reset
-            if ndx >= batch_stopndx:
-                yield row_batch
-                batch_stopndx = 0
-                row_batch.clear()
+    return header_size, matrix_dims, delimiter
 
-            # Accumulate row into current batch
-            row_batch.append(normalize(stripped_line.split(' ')))
+
+def StreamMatrixData(mtx_datafile: Path, batch_size: int):
+    """
+    Parses the entries of an MTX-formatted matrix and yields them in batches of at most
+    :batch_size: entries. Each batch is a tuple of 3 numpy arrays (columns): row indices
+    and column indices as int32, and values as float64.
+
+    The file is memory-mapped and parsed by numpy one window (of whole lines) at a time,
+    so no python objects are created per matrix entry and only the current window of
+    the file needs to be paged in.
+    """
+
+    # A convenience function to split parsed entries into narrowly typed columns
+    def as_columns(entries):
+        return (
+             entries[:, 0].astype(numpy.int32)
+            ,entries[:, 1].astype(numpy.int32)
+            ,numpy.ascontiguousarray(entries[:, 2])
+        )
+
+    if batch_size < 1:
+        raise ValueError(f'Batch size must be positive: {batch_size}')
+
+    # >> Roughly the bytes per line of an MTX file, so a window holds about one batch
+    window_size = batch_size * 32
+
+    header_size, matrix_dims, _ = ParseMatrixHeader(mtx_datafile)
+    entry_count                 = 0
+
+    with mtx_datafile.open('rb') as file_handle:
+        with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mtx_buffer:
+            # >> Skip the header, which has already been parsed
+            body_offset = 0
+            for _ in range(header_size):
+                body_offset = mtx_buffer.find(b'\n', body_offset) + 1 or len(mtx_buffer)
+
+            # >> Parse a window at a time; whitespace of any kind separates values
+            row_batch = numpy.empty((0, 3), dtype=numpy.float64)
+            while body_offset < len(mtx_buffer):
+                window_end = (
+                       mtx_buffer.find(b'\n', body_offset + window_size) + 1
+                    or len(mtx_buffer)
+                )
+
+                window_data = numpy.fromstring(
+                    mtx_buffer[body_offset:window_end], dtype=numpy.float64, sep=' '
+                ).reshape(-1, 3)
+
+                body_offset  = window_end
+                entry_count += len(window_data)
+                row_batch    = numpy.concatenate((row_batch, window_data))
+
+                # if batch is complete, yield it and keep the remainder for the next one
+                while len(row_batch) >= batch_size:
+                    yield as_columns(row_batch[:batch_size])
+                    row_batch = row_batch[batch_size:]
 
     # yield remaining rows
-    yield row_batch
+    if len(row_batch):
+        yield as_columns(row_batch)
+
+    if matrix_dims and entry_count != matrix_dims[2]:
+        raise ValueError(
+            f'Parsed {entry_count} of {matrix_dims[2]} entries from {mtx_datafile}'
+        )
 
 
 # ------------------------------
 # Classes
 
 class ExprDB:
-    default_dbpath = 'resources/exprdb.duckdb'
+    default_dbpath    = 'resources/exprdb.duckdb'
+    default_batchsize = 50000
+
+    # >> Column types of the 'expr' table, for streaming record batches into it
+    expr_schema = pyarrow.schema([
+         ('gene_id', pyarrow.string())
+        ,('cell_id', pyarrow.string())
+        ,('expr'   , pyarrow.float64())
+    ])
 
     @classmethod
     def InMemory(cls):
@@ -116,8 +209,24 @@ class ExprDB:
         """
 
         super().__init__(**kwargs)
-        self.__dbconn   = db_conn
-        self._sequences = {}
+        self.__dbconn        = db_conn
+        self._sequences      = {}
+        self._in_transaction = False
+
+    def Cursor(self):
+        """
+        Returns a new ExprDB instance for the same database, using a duplicate of this
+        instance's connection. Each thread should use its own instance, for example to
+        load several datasets in parallel:
+            worker_db = db.Cursor()
+        """
+
+        return self.__class__(self.__dbconn.cursor())
+
+    def Close(self):
+        """ Closes this instance's connection, such as one created by `Cursor`. """
+
+        self.__dbconn.close()
 
     def CreateSequence(self, sequence_name, seq_incr=1, seq_start=1):
         # >> Drop the sequence; ignore any exception from this
@@ -134,35 +243,172 @@ class ExprDB:
             f'     NO CYCLE'
         )
 
-    def CreateExprData(self, table='expr'):
+    def CreateExprData(self, table='expr', droppable_keys=False):
+        """
+        Creates the table of expression data. If :droppable_keys: is set, the primary key
+        is enforced by a unique index (and NOT NULL key columns) instead of a table
+        constraint, so that it can be dropped while bulk loading (see `BulkLoadMTX`).
+        """
+
+        key_constraints = '' if droppable_keys else '    ,PRIMARY KEY(gene_id, cell_id)'
+        key_not_null    = ' NOT NULL' if droppable_keys else ''
+
+        # >> Create the table itself
         self.__dbconn.execute(
             f' CREATE OR REPLACE TABLE {table} ('
-            f'     gene_id VARCHAR'
-            f'    ,cell_id VARCHAR'
+            f'     gene_id VARCHAR{key_not_null}'
+            f'    ,cell_id VARCHAR{key_not_null}'
             f'    ,expr    DOUBLE'
-            f'    ,PRIMARY KEY(gene_id, cell_id)'
+            f'{key_constraints}'
             f')'
         )
 
-    def CreateClusterData(self, table='clusters'):
+        # >> Droppable keys are created as indexes instead of table constraints
+        if droppable_keys:
+            self.__dbconn.execute(
+                f'CREATE UNIQUE INDEX {table}_pkey ON {table} (gene_id, cell_id)'
+            )
+
+    def CreateClusterData(self, table='clusters', droppable_keys=False):
+        """
+        Creates the table of cluster associations. :droppable_keys: is the same as for
+        `CreateExprData` (see `BulkLoadClusters`).
+        """
+
+        key_constraints = '' if droppable_keys else (
+            '    ,PRIMARY KEY(metacluster_id, cluster_id, cell_id)'
+            '    ,UNIQUE(cell_id, dataset_name)'
+        )
+        key_not_null = ' NOT NULL' if droppable_keys else ''
+
         # >> Create the table itself
         self.__dbconn.execute(
             f' CREATE OR REPLACE TABLE {table} ('
-            f'     metacluster_id INT'
-            f'    ,cluster_id     INT'
-            f'    ,cell_id        VARCHAR'
+            f'     metacluster_id INT{key_not_null}'
+            f'    ,cluster_id     INT{key_not_null}'
+            f'    ,cell_id        VARCHAR{key_not_null}'
             f'    ,dataset_name   VARCHAR'
-            f'    ,PRIMARY KEY(metacluster_id, cluster_id, cell_id)'
-            f'    ,UNIQUE(cell_id, dataset_name)'
+            f'{key_constraints}'
             f')'
         )
 
-    def InsertData(self, tuple_list, table_name):
-        """ Convenience method for inserting many tuples into a table.  """
+        # >> Droppable keys are created as indexes instead of table constraints
+        if droppable_keys:
+            self.__dbconn.execute(
+                f' CREATE UNIQUE INDEX {table}_pkey'
+                f' ON {table} (metacluster_id, cluster_id, cell_id)'
+            )
+            self.__dbconn.execute(
+                f'CREATE UNIQUE INDEX {table}_cell_key ON {table} (cell_id, dataset_name)'
+            )
+
+    @contextmanager
+    def IndexesDropped(self, table):
+        """
+        Context manager that drops every index on :table: and recreates them when the
+        block exits, for example to bulk load data and then build the indexes once:
+            with db.IndexesDropped('expr'):
+                db.LoadMTX(mtx_dirpath, mtx_basename)
+
+        Constraints declared as part of the table are not indexes and are unaffected (a
+        warning is logged if :table: has no indexes to drop). The block and the rebuild
+        run in one transaction, so if the loaded data violates a unique index the load is
+        rolled back (and the index is still rebuilt).
+
+        The indexes are dropped (and committed) before that transaction begins, so this
+        is not atomic: if the process dies before the rebuild, the indexes are lost. For
+        the same reason, this can't be used within `Transaction`; duckdb can't recreate
+        an index in the transaction that dropped it.
+        """
+
+        if self._in_transaction:
+            raise RuntimeError(
+                f'Indexes on {table} can not be dropped within a transaction'
+            )
 
         self.__dbconn.execute(
-            f" INSERT INTO {table_name} VALUES {','.join(tuple_list)}"
+            'SELECT index_name, sql FROM duckdb_indexes() WHERE table_name = ?', [table]
         )
+        index_defs = self.__dbconn.fetchall()
+
+        if not index_defs:
+            logger.warning(
+                'No indexes on %s to drop; create it with droppable_keys=True', table
+            )
+
+        for index_name, _ in index_defs:
+            self.__dbconn.execute(f'DROP INDEX {index_name}')
+
+        try:
+            with self.Transaction():
+                yield self
+
+                for _, index_sql in index_defs:
+                    self.__dbconn.execute(index_sql)
+
+        except:
+            for _, index_sql in index_defs:
+                self.__dbconn.execute(index_sql)
+
+            raise
+
+    @contextmanager
+    def Transaction(self):
+        """
+        Context manager that wraps the statements executed within it in a single
+        transaction. The transaction is committed when the block exits normally and is
+        rolled back if the block raises an exception, for example:
+            with db.Transaction():
+                db.InsertExprData(expr_tuples)
+
+        Nested uses join the outermost transaction.
+        """
+
+        if self._in_transaction:
+            yield self
+            return
+
+        self.__dbconn.execute('BEGIN TRANSACTION')
+        self._in_transaction = True
+
+        try:
+            yield self
+
+        except:
+            self.__dbconn.execute('ROLLBACK')
+            raise
+
+        finally:
+            self._in_transaction = False
+
+        self.__dbconn.execute('COMMIT')
+
+    def InsertData(self, tuple_list, table_name):
+        """
+        Convenience method for inserting many tuples into a table. The tuples are
+        transposed into an arrow table that duckdb scans directly, rather than rendered
+        into an `INSERT ... VALUES` statement that duckdb would have to parse and plan.
+        """
+
+        if not tuple_list: return
+
+        column_data = [pyarrow.array(column) for column in zip(*tuple_list)]
+        self.InsertTable(
+             pyarrow.Table.from_arrays(
+                 column_data, names=[f'col_{ndx}' for ndx in range(len(column_data))]
+             )
+            ,table_name
+        )
+
+    def InsertTable(self, data_table, table_name):
+        """
+        Convenience method for inserting an arrow table (or anything else duckdb can
+        scan, such as a pandas DataFrame) into a table. Columns are matched by position.
+        """
+
+        self.__dbconn.register('insert_batch', data_table)
+        self.__dbconn.execute(f'INSERT INTO {table_name} SELECT * FROM insert_batch')
+        self.__dbconn.unregister('insert_batch')
 
     def InsertExprData(self, expr_tuples, table='expr'):
         """ Wrapper for InsertData using the 'expr' table. """
@@ -183,11 +429,11 @@ class ExprDB:
         """
 
         # >> Call nextval on the DB sequence
-        self.__dbconn.execute(f"SELECT nextval('{sequence_name}')")
+        self.__dbconn.execute('SELECT nextval(?)', [sequence_name])
 
         # >> Use local variables to cache the value
         if sequence_name not in self._sequences:
-            seq_val = self.__dbconn.fetchall()[0]
+            seq_val = self.__dbconn.fetchall()[0][0]
             self._sequences[sequence_name] = itertools.count(start=seq_val)
 
         return next(self._sequences[sequence_name])
@@ -232,57 +478,207 @@ class ExprDB:
         :mtx_dirpath: specifies a root directory for the MTX files, :mtx_basename:
         specifies the name to use for the dataset as well as the prefix for the MTX files
         for the dataset.
+
+        The matrix entries are parsed by duckdb's CSV reader and mapped to their gene and
+        cell IDs with a join, so no rows of the matrix pass through python.
         """
 
+        dbconn          = self.__dbconn
         dirpath         = Path(mtx_dirpath)
         filepath_prefix = f'{mtx_basename}.aggregated_filtered_counts'
+        mtx_datafile    = dirpath / f'{filepath_prefix}_matrix.mtx'
 
         col_meta = ParseIDs(dirpath / f'{filepath_prefix}.mtx_cols')
         row_meta = ParseIDs(dirpath / f'{filepath_prefix}.mtx_rows')
 
-        # for each slice of the expression matrix
-        for matrix_batch in StreamMatrixData(dirpath / f'{filepath_prefix}_matrix.mtx'):
-            tuple_list = []
+        header_size, matrix_dims, delimiter = ParseMatrixHeader(mtx_datafile)
+        if delimiter is None:
+            raise ValueError(f'Unsupported delimiter between MTX values: {mtx_datafile}')
+
+        # >> Check the gene IDs once, rather than for every entry that uses them
+        empty_count = numpy.count_nonzero(row_meta[1:] == '')
+        if empty_count:
+            logger.warning('Dataset %s has %d empty gene IDs', mtx_basename, empty_count)
+
+        # >> duckdb's CSV reader can't sniff a file without entries, so skip the scan
+        if matrix_dims and matrix_dims[2] == 0:
+            return
+
+        # >> Expose the metadata to duckdb so matrix indices can be joined to their IDs
+        dbconn.register('mtx_cols', pyarrow.table({
+            'ndx': numpy.arange(1, len(col_meta)), 'id': col_meta[1:]
+        }))
+        dbconn.register('mtx_rows', pyarrow.table({
+            'ndx': numpy.arange(1, len(row_meta)), 'id': row_meta[1:]
+        }))
+
+        # >> Scan the matrix and insert each entry with its gene and cell IDs. Entries
+        #    with an index that has no ID are dropped by the joins, so the number of
+        #    inserted entries is checked against the header
+        try:
+            with self.Transaction():
+                dbconn.execute(
+                    ' INSERT INTO expr'
+                    ' SELECT r.id, c.id, x.expr'
+                    ' FROM   read_csv(?'
+                    '                 ,delim=?'
+                    '                 ,header=false'
+                    '                 ,skip=?'
+                    "                 ,columns={'row_ndx': 'INTEGER'"
+                    "                          ,'col_ndx': 'INTEGER'"
+                    "                          ,'expr'   : 'DOUBLE'}"
+                    '        ) x'
+                    '        JOIN mtx_rows r ON r.ndx = x.row_ndx'
+                    '        JOIN mtx_cols c ON c.ndx = x.col_ndx'
+                    ,[str(mtx_datafile), delimiter, header_size]
+                )
+
+                entry_count = dbconn.fetchall()[0][0]
+                if matrix_dims and entry_count != matrix_dims[2]:
+                    raise ValueError(
+                        f'Loaded {entry_count} of {matrix_dims[2]} entries'
+                        f' from {mtx_datafile}'
+                    )
+
+        finally:
+            dbconn.unregister('mtx_cols')
+            dbconn.unregister('mtx_rows')
+
+    def BulkLoadMTX(self, mtx_dirpath: Path, mtx_basename: str, drop_constraints=True):
+        """
+        Loads expression data like `LoadMTX`. If :drop_constraints: is set, the indexes
+        on the 'expr' table are dropped during the load and rebuilt afterwards, instead of
+        being probed for every inserted row. This only applies to keys created with
+        `CreateExprData(droppable_keys=True)`.
+
+        Rebuilding covers the whole table, so this pays off when the table is empty or
+        small compared to the dataset being loaded.
+        """
+
+        if not drop_constraints:
+            return self.LoadMTX(mtx_dirpath, mtx_basename)
+
+        with self.IndexesDropped('expr'):
+            self.LoadMTX(mtx_dirpath, mtx_basename)
+
+    def StreamMTX(self, mtx_dirpath: Path, mtx_basename: str, batch_size: int = None):
+        """
+        Loads expression data from MTX-formatted files, like `LoadMTX`, but parses the
+        matrix with numpy and hands it to duckdb as a stream of arrow record batches.
+        This is slower than `LoadMTX` and is useful when the rows of the matrix need to
+        be handled in python.
 
-            # map row and column indices to their actual values
-            for matrix_row in matrix_batch:
-                row_id = row_meta[matrix_row[0]]
-                col_id = col_meta[matrix_row[1]]
+        :batch_size: is the number of matrix entries per record batch and defaults to
+        `default_batchsize`, which can be overridden to tune all loads.
 
-                if not row_id:
-                    print(f'Empty gene ID: {row_id}')
+        Raises ValueError, and inserts nothing, if a matrix index has no ID or the matrix
+        has fewer entries than its header declares.
+        """
 
-                tuple_list.append(f"('{row_id}', '{col_id}', {matrix_row[2]})")
+        dirpath         = Path(mtx_dirpath)
+        filepath_prefix = f'{mtx_basename}.aggregated_filtered_counts'
+        mtx_datafile    = dirpath / f'{filepath_prefix}_matrix.mtx'
+        batch_size      = self.default_batchsize if batch_size is None else batch_size
+
+        col_meta   = ParseIDs(dirpath / f'{filepath_prefix}.mtx_cols')
+        row_meta   = ParseIDs(dirpath / f'{filepath_prefix}.mtx_rows')
+        load_error = None
+
+        # A convenience function to check a column of indices before it is used to gather
+        # IDs: index 0 is the placeholder of `ParseIDs` and negative indices wrap around
+        def check_ndxs(ndxs, meta, axis_name):
+            if ndxs.min() < 1 or ndxs.max() >= len(meta):
+                raise ValueError(
+                    f'{axis_name} index out of range [1, {len(meta) - 1}]: {mtx_datafile}'
+                )
 
-            # load the slice into the database
-            self.InsertExprData(tuple_list)
+        def expr_batches():
+            nonlocal load_error
+
+            matrix_batches = StreamMatrixData(mtx_datafile, batch_size)
+
+            try:
+                # for each slice of the expression matrix
+                for row_ndxs, col_ndxs, expr_vals in matrix_batches:
+                    check_ndxs(row_ndxs, row_meta, 'Row')
+                    check_ndxs(col_ndxs, col_meta, 'Column')
+
+                    # map row and column indices to their actual values, column by column
+                    gene_ids = row_meta[row_ndxs]
+                    cell_ids = col_meta[col_ndxs]
+
+                    empty_count = numpy.count_nonzero(gene_ids == '')
+                    if empty_count:
+                        logger.warning('Batch has %d empty gene IDs', empty_count)
+
+                    yield pyarrow.record_batch(
+                         [
+                              pyarrow.array(gene_ids, type=pyarrow.string())
+                             ,pyarrow.array(cell_ids, type=pyarrow.string())
+                             ,pyarrow.array(expr_vals)
+                         ]
+                        ,schema=self.expr_schema
+                    )
+
+            # an exception raised inside duckdb's scan is rewrapped (and can abort the
+            # interpreter on exit), so end the stream and raise it after the insert
+            except ValueError as parse_error:
+                load_error = parse_error
+
+        # >> Insert every batch with a single statement; duckdb pulls each record batch
+        #    as it scans, so only one batch is materialized at a time. A bad matrix rolls
+        #    back the entries inserted before the error was found
+        with self.Transaction():
+            self.InsertTable(
+                 pyarrow.RecordBatchReader.from_batches(self.expr_schema, expr_batches())
+                ,'expr'
+            )
+
+            if load_error is not None:
+                raise load_error
 
     def LoadClusters(self, dir_path: Path, file_name: str = 'clusters.tsv'):
         """
         Loads cluster associations from a TSV-formatted file. The file is expected to have
-        two columns: <cluster ID> | <column name>
+        three columns: <meta cluster ID> | <cluster ID> | <column name>
 
-        The cluster ID column is expected to be an integer ID that is unique within the
-        dataset. The "column name" column is expected to be a string ID that corresponds
-        to the ID of a single-cell in the MTX-formatted data files.
+        The cluster ID columns are expected to be integer IDs; the cluster ID is unique
+        within the dataset. The "column name" column is expected to be a string ID that
+        corresponds to the ID of a single-cell in the MTX-formatted data files.
+
+        The file is read by duckdb's CSV reader and each association is inserted along
+        with the dataset name (the name of :dir_path:).
         """
 
-        cluster_filepath = dir_path / file_name
-
-        # >> Create a dictionary mapping a cluster ID to a list of single-cell IDs
-        cluster_tuples = []
-        with cluster_filepath.open() as file_handle:
-            for line in file_handle:
-                # "mcluster" is meta cluster; "dcluster" is dataset cluster
-                mcluster_id, dcluster_id, cell_id = line.strip().split('\t')
-                cluster_tuples.append(
-                    '('
-                    f'  {int(mcluster_id.strip())}'
-                    f' ,{int(dcluster_id.strip())}'
-                    f" ,'{cell_id.strip()}'"
-                    f" ,'{dir_path.name}'"
-                    ')'
-                )
+        dirpath          = Path(dir_path)
+        dataset_name     = dirpath.name
+        cluster_filepath = dirpath / file_name
+
+        # "mcluster" is meta cluster; "dcluster" is dataset cluster
+        self.__dbconn.execute(
+            ' INSERT INTO clusters'
+            ' SELECT mcluster_id, dcluster_id, trim(cell_id), ?'
+            ' FROM   read_csv(?'
+            "                 ,delim='\t'"
+            '                 ,header=false'
+            "                 ,columns={'mcluster_id': 'INTEGER'"
+            "                          ,'dcluster_id': 'INTEGER'"
+            "                          ,'cell_id'    : 'VARCHAR'}"
+            '        )'
+            ,[dataset_name, str(cluster_filepath)]
+        )
+
+    def BulkLoadClusters(self
+                        ,dir_path:         Path
+                        ,file_name:        str  = 'clusters.tsv'
+                        ,drop_constraints: bool = True):
+        """
+        Loads cluster associations like `LoadClusters`, dropping and rebuilding the
+        indexes on the 'clusters' table the same way as `BulkLoadMTX`.
+        """
+
+        if not drop_constraints:
+            return self.LoadClusters(dir_path, file_name)
 
-        # >> Use the dictionary to populate the 'clusters' table
-        self.InsertClusterData(cluster_tuples)
+        with self.IndexesDropped('clusters'):
+            self.LoadClusters(dir_path, file_name)
@@ -4,19 +4,415 @@
 # Dependencies
 
 # >> Standard lib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time
 
 # >> Third-party libs
 import duckdb
+import numpy
+import pytest
 
 # >> Internal modules
-from sandbox.expression import ExprDB
+from sandbox.expression import ExprDB, ParseMatrixHeader, StreamMatrixData
+
+
+# ------------------------------
+# Functions
+
+def write_matrix(mtx_datafile, entries, matrix_dims, delimiter=' '):
+    """ Writes :entries: (row index, column index, value) as an MTX-formatted matrix. """
+
+    with mtx_datafile.open('w') as file_handle:
+        file_handle.write('%%MatrixMarket matrix coordinate real general\n%\n')
+        file_handle.write(' '.join(map(str, matrix_dims)) + '\n')
+
+        for entry in entries:
+            file_handle.write(delimiter.join(map(str, entry)) + '\n')
+
+
+def write_dataset(dirpath, name, row_count, col_count, entries, **kwargs):
+    """
+    Writes a dataset named :name: under :dirpath: with :row_count: genes and :col_count:
+    cells, in the layout expected by `ExprDB.LoadMTX`. Keyword arguments are passed to
+    `write_matrix`; the matrix dimensions default to those of :entries:.
+    """
+
+    dataset_dirpath = dirpath / name
+    filepath_prefix = dataset_dirpath / f'{name}.aggregated_filtered_counts'
+    dataset_dirpath.mkdir(parents=True)
+
+    with Path(f'{filepath_prefix}.mtx_rows').open('w') as file_handle:
+        for row_ndx in range(1, row_count + 1):
+            file_handle.write(f'G{row_ndx}\tG{row_ndx}\n')
+
+    with Path(f'{filepath_prefix}.mtx_cols').open('w') as file_handle:
+        for col_ndx in range(1, col_count + 1):
+            file_handle.write(f'{name}_C{col_ndx}\n')
+
+    with (dataset_dirpath / 'clusters.tsv').open('w') as file_handle:
+        for col_ndx in range(1, col_count + 1):
+            file_handle.write(f'12\t{col_ndx % 3}\t{name}_C{col_ndx}\n')
+
+    kwargs.setdefault('matrix_dims', (row_count, col_count, len(entries)))
+    write_matrix(Path(f'{filepath_prefix}_matrix.mtx'), entries, **kwargs)
+
+    return dataset_dirpath
+
+
+def make_entries(row_count, col_count):
+    """ Returns an entry for every cell of a :row_count: x :col_count: matrix. """
+
+    return [
+        (row_ndx, col_ndx, round(row_ndx + col_ndx / 100, 2))
+        for col_ndx in range(1, col_count + 1)
+        for row_ndx in range(1, row_count + 1)
+    ]
 
 
 # ------------------------------
 # Classes
 
+class TestStreamMatrix:
+    def test_batch_sizes(self, tmp_path):
+        """
+        Every batch but the last has exactly :batch_size: entries, and no entry is lost
+        or repeated, including when a parsed window ends in the middle of a batch.
+        """
+
+        entries      = make_entries(20, 11)
+        mtx_datafile = tmp_path / 'matrix.mtx'
+        write_matrix(mtx_datafile, entries, (20, 11, len(entries)))
+
+        for batch_size in (1, 7, 64, len(entries), len(entries) + 1):
+            batches = list(StreamMatrixData(mtx_datafile, batch_size))
+
+            assert [len(batch[0]) for batch in batches[:-1]] == (
+                [batch_size] * (len(batches) - 1)
+            )
+            assert 0 < len(batches[-1][0]) <= batch_size
+
+            streamed = [
+                (int(row_ndx), int(col_ndx), float(expr_val))
+                for row_ndxs, col_ndxs, expr_vals in batches
+                for row_ndx, col_ndx, expr_val in zip(row_ndxs, col_ndxs, expr_vals)
+            ]
+            assert streamed == entries
+
+    @pytest.mark.parametrize('batch_size', [0, -1])
+    def test_invalid_batch_size(self, tmp_path, batch_size):
+        entries         = make_entries(3, 2)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 3, 2, entries)
+        mtx_datafile    = dataset_dirpath / 'DS1.aggregated_filtered_counts_matrix.mtx'
+
+        with pytest.raises(ValueError, match='Batch size'):
+            next(StreamMatrixData(mtx_datafile, batch_size))
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+
+        with pytest.raises(ValueError, match='Batch size'):
+            expr_db.StreamMTX(dataset_dirpath, 'DS1', batch_size)
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(0,)]
+
+    def test_column_types(self, tmp_path):
+        mtx_datafile = tmp_path / 'matrix.mtx'
+        write_matrix(mtx_datafile, make_entries(3, 2), (3, 2, 6))
+
+        row_ndxs, col_ndxs, expr_vals = next(StreamMatrixData(mtx_datafile, 4))
+        assert row_ndxs.dtype == numpy.int32
+        assert col_ndxs.dtype == numpy.int32
+        assert expr_vals.dtype == numpy.float64
+
+
+class TestMatrixHeader:
+    @pytest.mark.parametrize(
+         'delimiter, expected'
+        ,[(' ', ' '), ('\t', '\t'), ('  ', None), (' \t', None)]
+    )
+    def test_delimiter(self, tmp_path, delimiter, expected):
+        mtx_datafile = tmp_path / 'matrix.mtx'
+        write_matrix(mtx_datafile, make_entries(3, 2), (3, 2, 6), delimiter=delimiter)
+
+        assert ParseMatrixHeader(mtx_datafile) == (3, (3, 2, 6), expected)
+
+    def test_unsupported_delimiter(self, tmp_path):
+        """
+        Runs of spaces can't be read by duckdb's CSV reader, so `LoadMTX` rejects them,
+        but `StreamMTX` parses them.
+        """
+
+        entries         = make_entries(5, 4)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries, delimiter='  ')
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+
+        with pytest.raises(ValueError, match='Unsupported delimiter'):
+            expr_db.LoadMTX(dataset_dirpath, 'DS1')
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(0,)]
+
+        expr_db.StreamMTX(dataset_dirpath, 'DS1')
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(len(entries),)]
+
+
+@pytest.mark.parametrize('load_method', ['LoadMTX', 'StreamMTX'])
+class TestLoadMTX:
+    def test_load(self, load_method, tmp_path):
+        entries         = make_entries(5, 4)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries)
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+        getattr(expr_db, load_method)(dataset_dirpath, 'DS1')
+
+        assert sorted(expr_db.QueryData('SELECT * FROM expr')) == sorted(
+            (f'G{row_ndx}', f'DS1_C{col_ndx}', expr_val)
+            for row_ndx, col_ndx, expr_val in entries
+        )
+
+    def test_tab_delimiter(self, load_method, tmp_path):
+        entries         = make_entries(5, 4)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries, delimiter='\t')
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+        getattr(expr_db, load_method)(dataset_dirpath, 'DS1')
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(len(entries),)]
+
+    def test_padded_ids(self, load_method, tmp_path):
+        """ IDs are stripped the same for expression and cluster data, so they join. """
+
+        entries         = make_entries(5, 4)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries)
+        cols_filepath   = dataset_dirpath / 'DS1.aggregated_filtered_counts.mtx_cols'
+
+        cols_filepath.write_text(''.join(
+            f' DS1_C{col_ndx} \tcell {col_ndx}\n' for col_ndx in range(1, 5)
+        ))
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+        expr_db.CreateClusterData()
+        getattr(expr_db, load_method)(dataset_dirpath, 'DS1')
+        expr_db.LoadClusters(dataset_dirpath)
+
+        assert expr_db.QueryData(
+            'SELECT count(*) FROM expr JOIN clusters USING (cell_id)'
+        ) == [(len(entries),)]
+
+    def test_empty_matrix(self, load_method, tmp_path):
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 2, 2, [])
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+        getattr(expr_db, load_method)(dataset_dirpath, 'DS1')
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(0,)]
+
+    def test_truncated_matrix(self, load_method, tmp_path):
+        """
+        A matrix with fewer entries than its header declares fails the load, and the
+        entries read before the end of the file are rolled back.
+        """
+
+        entries = make_entries(5, 4)
+        write_dataset(tmp_path, 'DS1', 5, 4, entries)
+        write_dataset(tmp_path, 'DS2', 5, 4, entries[:-3], matrix_dims=(5, 4, 20))
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+        getattr(expr_db, load_method)(tmp_path / 'DS1', 'DS1')
+
+        with pytest.raises(ValueError, match='17 of 20 entries'):
+            getattr(expr_db, load_method)(tmp_path / 'DS2', 'DS2')
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(len(entries),)]
+
+    @pytest.mark.parametrize('bad_entry', [(0, 1, 5.0), (-1, 1, 5.0), (1, 5, 5.0)])
+    def test_index_out_of_range(self, load_method, tmp_path, bad_entry):
+        """ An index without an ID fails the load instead of storing a wrong ID. """
+
+        entries         = make_entries(5, 4) + [bad_entry]
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries)
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+
+        with pytest.raises(ValueError):
+            getattr(expr_db, load_method)(dataset_dirpath, 'DS1')
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(0,)]
+
+
+class TestLoadClusters:
+    @pytest.mark.parametrize('line_ending', ['\n', '\r\n'])
+    def test_load(self, tmp_path, line_ending):
+        """
+        Each association is stored with its cell ID trimmed and with the name of the
+        dataset directory.
+        """
+
+        dataset_dirpath = tmp_path / 'DS1'
+        dataset_dirpath.mkdir()
+
+        (dataset_dirpath / 'clusters.tsv').write_bytes(line_ending.join([
+             '12\t0\tDS1_C1'
+            ,'12\t1\t DS1_C2 '
+            ,'13\t2\tDS1_C3'
+            ,''
+        ]).encode())
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateClusterData()
+        expr_db.LoadClusters(dataset_dirpath)
+
+        assert sorted(expr_db.QueryData('SELECT * FROM clusters')) == [
+             (12, 0, 'DS1_C1', 'DS1')
+            ,(12, 1, 'DS1_C2', 'DS1')
+            ,(13, 2, 'DS1_C3', 'DS1')
+        ]
+
+
+class TestParallelLoad:
+    def load_dataset(self, expr_db, dataset_dirpath):
+        # >> Each thread uses its own connection to the database
+        expr_db = expr_db.Cursor()
+
+        try:
+            expr_db.LoadMTX(dataset_dirpath, dataset_dirpath.name)
+            expr_db.LoadClusters(dataset_dirpath)
+
+        finally:
+            expr_db.Close()
+
+    def test_load(self, tmp_path):
+        """ Load datasets into a file-backed database, each in its own thread. """
+
+        dataset_dirpaths = [
+             write_dataset(tmp_path, 'DS1', 5, 4, make_entries(5, 4))
+            ,write_dataset(tmp_path, 'DS2', 6, 3, make_entries(6, 3))
+        ]
+
+        expr_db = ExprDB.AsFile(str(tmp_path / 'exprdb.duckdb'))
+        expr_db.CreateExprData()
+        expr_db.CreateClusterData()
+
+        with ThreadPoolExecutor(max_workers=len(dataset_dirpaths)) as load_pool:
+            load_futures = [
+                load_pool.submit(self.load_dataset, expr_db, dataset_dirpath)
+                for dataset_dirpath in dataset_dirpaths
+            ]
+
+            for load_future in load_futures:
+                load_future.result()
+
+        assert expr_db.QueryData(
+            'SELECT dataset_name, count(*) FROM clusters GROUP BY 1 ORDER BY 1'
+        ) == [('DS1', 4), ('DS2', 3)]
+
+        assert expr_db.QueryData(
+            ' SELECT dataset_name, count(*)'
+            ' FROM   expr JOIN clusters USING (cell_id)'
+            ' GROUP BY 1 ORDER BY 1'
+        ) == [('DS1', 20), ('DS2', 18)]
+
+        expr_db.Close()
+
+
+class TestSequence:
+    def test_sequence_next(self):
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateSequence('metacluster_ids')
+
+        assert [expr_db.SequenceNext('metacluster_ids') for _ in range(3)] == [1, 2, 3]
+
+
+class TestBulkLoad:
+    def index_names(self, expr_db, table):
+        return expr_db.QueryData(
+            f"SELECT index_name FROM duckdb_indexes() WHERE table_name = '{table}'"
+        )
+
+    def test_within_transaction(self, tmp_path):
+        """ Indexes can't be dropped and rebuilt within an enclosing transaction. """
+
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, make_entries(5, 4))
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData(droppable_keys=True)
+
+        with pytest.raises(RuntimeError, match='within a transaction'):
+            with expr_db.Transaction():
+                expr_db.BulkLoadMTX(dataset_dirpath, 'DS1')
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(0,)]
+        assert self.index_names(expr_db, 'expr') == [('expr_pkey',)]
+
+    def test_droppable_keys_not_null(self):
+        """ Key columns reject NULLs without a primary key constraint to enforce it. """
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData(droppable_keys=True)
+        expr_db.CreateClusterData(droppable_keys=True)
+
+        with pytest.raises(duckdb.Error):
+            expr_db.InsertExprData([(None, 'DS1_C1', 1.0)])
+
+        with pytest.raises(duckdb.Error):
+            expr_db.InsertClusterData([(12, 0, None, 'DS1')])
+
+    def test_no_droppable_keys(self, tmp_path, caplog):
+        """ Bulk loading a table with constraint keys warns that nothing is dropped. """
+
+        entries         = make_entries(5, 4)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries)
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData()
+        expr_db.BulkLoadMTX(dataset_dirpath, 'DS1')
+
+        assert 'No indexes on expr to drop' in caplog.text
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(len(entries),)]
+
+    def test_reload_dataset(self, tmp_path):
+        """
+        Loading a dataset twice violates the unique indexes, which were dropped for the
+        load: the second load is rolled back and the indexes are rebuilt.
+        """
+
+        entries         = make_entries(5, 4)
+        dataset_dirpath = write_dataset(tmp_path, 'DS1', 5, 4, entries)
+
+        expr_db = ExprDB.InMemory()
+        expr_db.CreateExprData(droppable_keys=True)
+        expr_db.CreateClusterData(droppable_keys=True)
+
+        expr_db.BulkLoadMTX(dataset_dirpath, 'DS1')
+        expr_db.BulkLoadClusters(dataset_dirpath)
+
+        with pytest.raises(duckdb.Error):
+            expr_db.BulkLoadMTX(dataset_dirpath, 'DS1')
+
+        with pytest.raises(duckdb.Error):
+            expr_db.BulkLoadClusters(dataset_dirpath)
+
+        assert expr_db.QueryData('SELECT count(*) FROM expr') == [(len(entries),)]
+        assert expr_db.QueryData('SELECT count(*) FROM clusters') == [(4,)]
+
+        assert self.index_names(expr_db, 'expr') == [('expr_pkey',)]
+        assert sorted(self.index_names(expr_db, 'clusters')) == [
+            ('clusters_cell_key',), ('clusters_pkey',)
+        ]
+
+        # >> The rebuilt index is enforced again
+        with pytest.raises(duckdb.Error):
+            expr_db.InsertExprData([('G1', 'DS1_C1', 1.0)])
+
+
 class TestLoad:
     # >> Database instance
     expr_db = None
@@ -64,35 +460,53 @@ class TestLoad:
         print(f'Excerpt: {data_excerpt}')
 
     def test_load(self):
-        """ Load the data and specify the meta clusters. """
+        """ Load each dataset (in its own thread) and specify the meta clusters. """
+
+        with ThreadPoolExecutor(max_workers=len(self.dataset_names)) as load_pool:
+            load_futures = [
+                load_pool.submit(
+                    self.load_dataset, dataset_name, self.mtx_dirpaths[ndx] / dataset_name
+                )
+                for ndx, dataset_name in enumerate(self.dataset_names)
+            ]
 
-        for ndx, dataset_name in enumerate(self.dataset_names):
-            dataset_dirpath  = self.mtx_dirpaths[ndx] / dataset_name
-            print(f'[{dataset_dirpath}]:')
-            print(f'\t[{dataset_name}] |>')
+            # >> Surface any exception raised while loading
+            for load_future in load_futures:
+                load_future.result()
 
+    def load_dataset(self, name, dirpath):
+        # >> Each thread uses its own connection to the database
+        expr_db = self.expr_db.Cursor()
+
+        print(f'[{dirpath}]:')
+        print(f'\t[{name}] |>')
+
+        try:
             # >> First, load the expression data
             print('\t\texpression...')
-            self.load_expression(dataset_name, dataset_dirpath)
+            self.load_expression(expr_db, name, dirpath)
 
             # >> Then, load the cluster data
             print('\t\tclusters...')
-            self.load_clusters(dataset_name, dataset_dirpath)
+            self.load_clusters(expr_db, name, dirpath)
+
+        finally:
+            expr_db.Close()
 
-    def load_expression(self, name, dirpath):
+    def load_expression(self, expr_db, name, dirpath):
         tstart = time.time()
-        self.expr_db.LoadMTX(dirpath, name)
+        expr_db.LoadMTX(dirpath, name)
         tstop = time.time()
         print(f'\t\tElapsed time: {tstop - tstart}')
 
-        data_excerpt = '\n\t'.join(map(str, self.expr_db.ScanExpr()))
+        data_excerpt = '\n\t'.join(map(str, expr_db.ScanExpr()))
         print(f'\t\t{data_excerpt}')
 
-    def load_clusters(self, name, dirpath):
+    def load_clusters(self, expr_db, name, dirpath):
         tstart = time.time()
-        self.expr_db.LoadClusters(dirpath)
+        expr_db.LoadClusters(dirpath)
         tstop = time.time()
         print(f'\t\tElapsed time: {tstop - tstart}')
 
-        data_excerpt = '\n\t'.join(map(str, self.expr_db.ScanClusters()))
+        data_excerpt = '\n\t'.join(map(str, expr_db.ScanClusters()))
         print(f'\t\t{data_excerpt}')